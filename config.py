@@ -2,6 +2,7 @@
 Configuration settings for LaTeX Terminal Renderer.
 Adjust these values to customize the appearance of rendered equations.
 """
+import os
 
 # --- Inline Math Settings ( $...$ ) ---
 # Padding adds transparent space around the image to prevent clipping of tall/wide symbols (like arrows).
@@ -33,3 +34,39 @@ BLOCK_MATH_MARGIN_BOTTOM = 0
 
 # Resolution for block math images.
 BLOCK_MATH_DPI = 200
+
+
+# --- Performance Settings ---
+# Draw single-glyph formulas and plain numbers ($x$, $\alpha$, $42$) directly with Pillow instead of mathtext.
+FAST_SINGLE_GLYPH = True
+
+# Render equations in parallel worker processes before drawing.
+PARALLEL_RENDER = True
+
+# Minimum number of distinct equations before a process pool is used. Every
+# worker pays for its own Matplotlib import and the pool adds ~25 ms, against
+# ~7 ms per equation; below this the startup cost outweighs the gain.
+PARALLEL_RENDER_MIN_EQUATIONS = 16
+
+# Send each distinct image to the terminal once and re-place repeated
+# equations by image id, instead of retransmitting their PNG data. Images are
+# sent again once many newer ones followed them, since the terminal may have
+# dropped them by then.
+KITTY_IMAGE_REUSE = True
+
+# Draw formulas straight onto an Agg renderer, without building a figure per
+# equation. Disable to always draw through a figure.
+DIRECT_MATHTEXT = True
+
+# Rasterize with mplcairo instead of Agg when it is installed (pip install mplcairo).
+# Only figure renders use it: with DIRECT_MATHTEXT on, that is just the formulas
+# the direct renderer gives up on, so by default this has little effect.
+USE_MPLCAIRO = True
+
+# Keep rendered equations on disk between runs, keyed by a hash of the formula
+# and its render settings. Re-displaying a document then skips rendering entirely.
+DISK_CACHE = True
+DISK_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "latex-terminal")
+
+# The least recently used entries are removed once the cache grows past this size.
+DISK_CACHE_MAX_MB = 64
@@ -1,4 +1,6 @@
+import functools
 import re
+import unicodedata
 
 # Symbols that are known to render poorly (clipping, missing) in Matplotlib's engine.
 # If these are detected, we force the use of the system LaTeX renderer (pdflatex).
@@ -7,47 +9,118 @@ FORCE_FALLBACK_SYMBOLS = {
     r"\impliedby", r"\implies", r"\iff"
 }
 
-def requires_system_fallback(latex_str):
-    """
-    Checks if the LaTeX string contains symbols that require the system renderer.
-    """
-    return any(sym in latex_str for sym in FORCE_FALLBACK_SYMBOLS)
-
-def sanitize_latex(content):
-    """
-    Sanitizes LaTeX content to ensure compatibility with Matplotlib's mathtext engine
-    and to fix common rendering issues (like clipping or missing symbols).
-    """
-    
+# Replacement table for sanitize_latex, applied in a single regex pass.
+_SANITIZE_TABLE = {
     # 1. Remove newlines
     # Matplotlib's single-line rendering doesn't handle newlines well in inline math.
-    content = content.replace('\n', ' ')
+    '\n': ' ',
 
     # 2. Robust replacements for inequalities
     # Matplotlib sometimes struggles with the short forms \le and \ge if not followed by space.
     # We replace them with the full \leq and \geq versions.
-    content = re.sub(r'\\le(?![a-zA-Z])', r'\\leq', content)
-    content = re.sub(r'\\ge(?![a-zA-Z])', r'\\geq', content)
+    r'\le': r'\leq',
+    r'\ge': r'\geq',
 
     # 3. Fix Absolute Values
     # Matplotlib's mathtext does not always render \lvert and \rvert correctly.
-    # We use single backslashes in the raw strings.
-    content = content.replace(r'\left\lvert', r'\left|')
-    content = content.replace(r'\right\rvert', r'\right|')
-    content = content.replace(r'\lvert', '|')
-    content = content.replace(r'\rvert', '|')
+    r'\left\lvert': r'\left|',
+    r'\right\rvert': r'\right|',
+    r'\lvert': '|',
+    r'\rvert': '|',
 
     # 4. Map Arrows to Prevent Clipping
     # We map semantic names to standard ones and add a zero-width rule for height.
-    # \impliedby (<==)
-    content = content.replace(r'\impliedby', r'\Longleftarrow\rule{0pt}{2.5ex}')
-    # \implies (==>)
-    content = content.replace(r'\implies', r'\Longrightarrow\rule{0pt}{2.5ex}')
-    # \iff (<==>)
-    content = content.replace(r'\iff', r'\Longleftrightarrow\rule{0pt}{2.5ex}')
+    r'\impliedby': r'\Longleftarrow\rule{0pt}{2.5ex}',       # <==
+    r'\implies': r'\Longrightarrow\rule{0pt}{2.5ex}',        # ==>
+    r'\iff': r'\Longleftrightarrow\rule{0pt}{2.5ex}',        # <==>
+}
+
+# Precompiled patterns (sanitize_latex / sanitize_for_fallback run once per equation).
+# \left\lvert / \right\rvert must be tried before the bare \lvert / \rvert.
+_RE_SANITIZE = re.compile(
+    r'\n|\\le(?![a-zA-Z])|\\ge(?![a-zA-Z])'
+    r'|\\left\\lvert|\\right\\rvert|\\lvert|\\rvert'
+    r'|\\impliedby|\\implies|\\iff'
+)
+# Matches any of FORCE_FALLBACK_SYMBOLS in a single scan.
+_RE_FORCE_FALLBACK = re.compile("|".join(re.escape(sym) for sym in sorted(FORCE_FALLBACK_SYMBOLS)))
+_RE_SINGLE_GLYPH = re.compile(r'\$\s*(\\[a-zA-Z]+|[a-zA-Z]|[0-9]+(?:\.[0-9]+)?)\s*\$')
+_RE_ENV_BEGIN = re.compile(r"\\begin{(align|equation|gather|dmath|multline|eqnarray|flalign)}")
+_RE_ENV_END = re.compile(r"\\end{(align|equation|gather|dmath|multline|eqnarray|flalign)}")
+_RE_HEIGHT_RULE = re.compile(r'\\rule{0pt}{[0-9.]*ex}')
+_RE_VPHANTOM = re.compile(r'\\vphantom{[a-zA-Z0-9]*}')
+
+# Commands that render as a single Unicode glyph (same code points as Matplotlib's mathtext).
+SINGLE_GLYPH_SYMBOLS = {
+    r"\alpha": "\u03b1", r"\beta": "\u03b2", r"\gamma": "\u03b3", r"\delta": "\u03b4",
+    r"\epsilon": "\u03f5", r"\varepsilon": "\u03b5", r"\zeta": "\u03b6", r"\eta": "\u03b7",
+    r"\theta": "\u03b8", r"\vartheta": "\u03d1", r"\iota": "\u03b9", r"\kappa": "\u03ba",
+    r"\lambda": "\u03bb", r"\mu": "\u03bc", r"\nu": "\u03bd", r"\xi": "\u03be",
+    r"\pi": "\u03c0", r"\rho": "\u03c1", r"\sigma": "\u03c3", r"\tau": "\u03c4",
+    r"\upsilon": "\u03c5", r"\phi": "\u03d5", r"\varphi": "\u03c6", r"\chi": "\u03c7",
+    r"\psi": "\u03c8", r"\omega": "\u03c9",
+    r"\Gamma": "\u0393", r"\Delta": "\u0394", r"\Theta": "\u0398", r"\Lambda": "\u039b",
+    r"\Xi": "\u039e", r"\Pi": "\u03a0", r"\Sigma": "\u03a3", r"\Upsilon": "\u03a5",
+    r"\Phi": "\u03a6", r"\Psi": "\u03a8", r"\Omega": "\u03a9",
+    r"\infty": "\u221e", r"\partial": "\u2202", r"\nabla": "\u2207", r"\ell": "\u2113",
+}
+
+def single_glyph(latex_str):
+    """
+    Returns (text, italic) if the formula is a single letter or symbol, or a plain
+    number (e.g. $x$, $\alpha$, $42$, $3.14$), that can be drawn without Matplotlib, else None.
+    Italic follows mathtext: letters are italic except uppercase Greek; numbers are upright.
+    """
+    match = _RE_SINGLE_GLYPH.fullmatch(latex_str)
+    if not match:
+        return None
 
-    return content
+    token = match.group(1)
+    text = SINGLE_GLYPH_SYMBOLS.get(token) if token.startswith('\\') else token
+    if text is None:
+        return None
 
+    first = text[0]
+    italic = unicodedata.category(first).startswith('L') and not unicodedata.name(first).startswith('GREEK CAPITAL')
+    return text, italic
+
+def requires_system_fallback(latex_str):
+    """
+    Checks if the LaTeX string contains symbols or environments that require the system renderer.
+    """
+    # Every forced-fallback symbol is a command; plain formulas like $x+y$ skip the search
+    if '\\' not in latex_str:
+        return False
+    # mathtext has no environments, so align/gather/... would always fail there first
+    if '\\begin{' in latex_str:
+        return True
+    return _RE_FORCE_FALLBACK.search(latex_str) is not None
+
+def _sanitize_replacement(match):
+    return _SANITIZE_TABLE[match.group(0)]
+
+@functools.lru_cache(maxsize=1024)
+def sanitize_latex(content):
+    """
+    Sanitizes LaTeX content to ensure compatibility with Matplotlib's mathtext engine
+    and to fix common rendering issues (like clipping or missing symbols).
+    """
+    # Every replacement starts with a backslash or is a newline; most inline
+    # formulas ($x^2$, $a+b$) have neither, so skip the regex engine entirely.
+    if '\\' not in content and '\n' not in content:
+        return content
+
+    # All replacements (see _SANITIZE_TABLE) happen in one scan of the string.
+    # Results are memoized: each equation is sanitized once when its render job
+    # is collected and again when it is emitted, and documents repeat equations.
+    return _RE_SANITIZE.sub(_sanitize_replacement, content)
+
+
+def _starred_begin(match):
+    return f"\\begin{{{match.group(1)}*}}"
+
+def _starred_end(match):
+    return f"\\end{{{match.group(1)}*}}"
 
 def sanitize_for_fallback(latex_str):
     """
@@ -63,21 +136,13 @@ def sanitize_for_fallback(latex_str):
         
     # Suppress numbering
     # We include flalign here to ensuring it's recognized as a block env
-    env_pattern = r"\\begin{(align|equation|gather|dmath|multline|eqnarray|flalign)}"
-    
-    def replacer(match):
-        env_name = match.group(1)
-        return f"\\begin{{{env_name}*}}"
-
-    if re.search(env_pattern, inner):
-        final_latex = re.sub(env_pattern, replacer, inner)
-        final_latex = re.sub(r"\\end{(align|equation|gather|dmath|multline|eqnarray|flalign)}", lambda m: f"\\end{{{m.group(1)}*}}", final_latex)
-    else:
-        final_latex = inner
+    final_latex, n_envs = _RE_ENV_BEGIN.subn(_starred_begin, inner)
+    if n_envs:
+        final_latex = _RE_ENV_END.sub(_starred_end, final_latex)
 
     # Remove Matplotlib specific hacks (rules/phantoms) as pdflatex doesn't need them
-    final_latex = re.sub(r'\\rule{0pt}{[0-9.]*ex}', '', final_latex)
-    final_latex = re.sub(r'\\vphantom{[a-zA-Z0-9]*}', '', final_latex)
+    final_latex = _RE_HEIGHT_RULE.sub('', final_latex)
+    final_latex = _RE_VPHANTOM.sub('', final_latex)
 
     # Ensure math mode if not an environment
     if not final_latex.strip().startswith(r'\begin{'):
@@ -1,67 +1,354 @@
 import argparse
-import base64
+import atexit
+import codecs
+import functools
+import hashlib
+import importlib.util
 import io
-import re
 import sys
 import os
 import struct
 import fcntl
 import termios
-import math
 import subprocess
 import shutil
 import tempfile
-
-import matplotlib
-
-# Force non-interactive backend
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+import time
+from collections import namedtuple
 
 import config
-from latex_sanitizer import sanitize_latex, sanitize_for_fallback, requires_system_fallback
+from latex_sanitizer import sanitize_latex, sanitize_for_fallback, requires_system_fallback, single_glyph
 
-# --- FIX: Switch from 'cm' to 'stix' or 'dejavusans' to fix missing symbol errors ---
+# pybase64 (optional) encodes with SIMD; its output is identical to the stdlib's
 try:
-    matplotlib.rcParams["mathtext.fontset"] = "stix"
-    matplotlib.rcParams["font.family"] = "STIXGeneral"
-except Exception:
-    matplotlib.rcParams["mathtext.fontset"] = "dejavusans"
-    matplotlib.rcParams["font.family"] = "sans-serif"
+    from pybase64 import standard_b64encode
+except ImportError:
+    from base64 import standard_b64encode
+
+# Matplotlib and Pillow are imported on first render (see _init_matplotlib):
+# the import alone takes hundreds of milliseconds and plain text never needs it.
+matplotlib = None
+Figure = FigureCanvas = FigureCanvasAgg = RendererAgg = None
+font_manager = None
+Image = ImageDraw = ImageFont = None
 
 # Constants
 CHUNK_SIZE = 4096
+# Source bytes per chunk; base64 maps 3 bytes to 4 characters.
+RAW_CHUNK_SIZE = CHUNK_SIZE // 4 * 3
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Prebuilt unpackers for the TIOCGWINSZ struct and the PNG IHDR size
+_WINSIZE = struct.Struct('HHHH')
+_PNG_SIZE = struct.Struct('>LL')
+
+# Maximum number of distinct renders kept in memory. Equations are usually
+# repeated verbatim ($x$, $n$, ...), so a hit skips Matplotlib/pdflatex entirely.
+RENDER_CACHE_SIZE = 512
+
+# Maximum equations typeset together by fallback_batches; bounds the
+# size of one pdflatex run.
+BATCH_RENDER_SIZE = 32
+
+# Bump when rendering changes so stale on-disk PNGs are no longer found
+DISK_CACHE_VERSION = 6
+# Set once _prune_disk_cache is registered to run at exit
+_DISK_CACHE_PRUNE_SCHEDULED = False
+
+# A rendered equation: PNG bytes and pixel size (png is None if rendering failed)
+RenderResult = namedtuple("RenderResult", "png w h")
+
+# Bytes read from piped stdin per chunk (see iter_stream_segments)
+STDIN_CHUNK_SIZE = 64 * 1024
+
+# Cursor movement escapes, formatted directly as bytes (CURSOR_UP % n)
+CURSOR_UP = b"\033[%dA"
+CURSOR_DOWN = b"\033[%dB"
+CURSOR_FORWARD = b"\033[%dC"
+CURSOR_BACK = b"\033[%dD"
+
+# zlib level for the PNG renders. They are sent to the terminal right away (or
+# cached), so level 1 trades a slightly larger payload for much faster encoding.
+PNG_COMPRESS_LEVEL = 1
+
+# Output is written once this many bytes are pending (see main); a few
+# block images, or hundreds of lines of text, per write(2).
+OUTPUT_FLUSH_SIZE = 64 * 1024
+
+# Repeated images are placed by id only while they are among this many most
+# recently transmitted ones. Kitty drops old images once its storage quota is
+# full, and with q=2 placing a dropped id fails silently; older ones are resent.
+KITTY_IMAGE_REUSE_LIMIT = 256
+
+# Kitty image ids of PNGs already transmitted, keyed by a hash of the PNG
+# (see display_image_kitty), and the number of ids handed out so far
+_KITTY_IMAGE_IDS = {}
+_KITTY_IMAGE_COUNT = 0
+_KITTY_IMAGE_ID_BASE = None
+# Shared Matplotlib text artists, one figure per DPI (see _get_text_artist)
+_TEXT_ARTISTS = {}
+# Process pool for parallel renders, started on first use (see render_jobs_parallel)
+_RENDER_POOL = None
+# Shared output buffer for PNG encoding (see _png_buffer)
+_PNG_BUF = io.BytesIO()
+
+# Preambles for the pdflatex fallback; %(border)s is the transparent padding
+# around each page, so the rasterized pages need no further processing.
+# BLOCK MODE: 'standalone' with preview option.
+# This matches the behavior of the "old working version" which handled flalign correctly.
+FALLBACK_BLOCK_PREAMBLE = r"""
+\documentclass[preview,border=%(border)s]{standalone}
+\usepackage{amsmath}
+\usepackage{amssymb}
+\usepackage[dvipsnames,svgnames,x11names]{xcolor}
+\usepackage{graphicx}
+
+"""
+# INLINE MODE: 'article' + 'preview'.
+# This is robust for long inline formulas and prevents them from wrapping.
+FALLBACK_INLINE_PREAMBLE = r"""
+\documentclass{article}
+\usepackage{amsmath}
+\usepackage{amssymb}
+\usepackage[dvipsnames,svgnames,x11names]{xcolor}
+\usepackage{graphicx}
+\usepackage[active,tightpage]{preview}
+\setlength\PreviewBorder{%(border)s}
+
+"""
+
+# Precompiled pdflatex formats keyed by preamble (see _get_fallback_format)
+_FALLBACK_FORMATS = {}
+# Seconds a failed format build is remembered before it is tried again
+# (e.g. after mylatexformat has been installed)
+FALLBACK_FORMAT_RETRY = 24 * 60 * 60
+
+
+def _init_matplotlib():
+    global matplotlib, Figure, FigureCanvas, FigureCanvasAgg, RendererAgg, font_manager, Image, ImageDraw, ImageFont
+    if Figure is not None:
+        return
+
+    import matplotlib
 
+    # Force non-interactive backend
+    matplotlib.use("Agg")
+    # The Figure API is used directly; pyplot's figure manager is never needed.
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg, RendererAgg
 
+    # mplcairo (optional) rasterizes small text figures faster than Agg.
+    FigureCanvas = FigureCanvasAgg
+    if config.USE_MPLCAIRO:
+        try:
+            from mplcairo.base import FigureCanvasCairo as FigureCanvas
+        except ImportError:
+            pass
+    from matplotlib import font_manager
+    from PIL import Image, ImageDraw, ImageFont  # Pillow is a Matplotlib dependency
+
+    # --- FIX: Switch from 'cm' to 'stix' or 'dejavusans' to fix missing symbol errors ---
+    try:
+        matplotlib.rcParams["mathtext.fontset"] = "stix"
+        matplotlib.rcParams["font.family"] = "STIXGeneral"
+    except Exception:
+        matplotlib.rcParams["mathtext.fontset"] = "dejavusans"
+        matplotlib.rcParams["font.family"] = "sans-serif"
+
+
+@functools.lru_cache(maxsize=1)
 def get_terminal_cell_dims():
     """
     Attempts to get the terminal cell width and height in pixels using ioctl.
     Returns (cell_w, cell_h, cols, rows). Defaults to (10, 20, 80, 24) if it fails.
+    Queried once per process; the output is laid out for a single window size.
     """
     try:
         buf = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, b'\0' * 8)
-        ws_row, ws_col, ws_xpixel, ws_ypixel = struct.unpack('HHHH', buf)
+        ws_row, ws_col, ws_xpixel, ws_ypixel = _WINSIZE.unpack(buf)
 
         if ws_col > 0 and ws_row > 0 and ws_xpixel > 0 and ws_ypixel > 0:
-            return ws_xpixel / ws_col, ws_ypixel / ws_row, ws_col, ws_row
+            # Whole pixels, so layout below can use integer arithmetic
+            return ws_xpixel // ws_col, ws_ypixel // ws_row, ws_col, ws_row
     except Exception:
         pass
     return 10, 20, 80, 24
 
 
+def ceil_div(a, b):
+    """
+    Integer ceiling division for pixel/cell arithmetic.
+    """
+    return -(-a // b)
+
+
 def get_png_dimensions(data):
-    if data[:8] != b'\x89PNG\r\n\x1a\n':
+    if not data.startswith(PNG_SIGNATURE):
+        return None
+    # IHDR width and height follow the signature and chunk header
+    return _PNG_SIZE.unpack_from(data, 16)
+
+
+def _format_dir():
+    return os.path.join(config.DISK_CACHE_DIR, "formats")
+
+
+def _get_fallback_format(preamble):
+    """
+    Dumps a fallback preamble into a pdflatex format file (via mylatexformat).
+    Later pdflatex runs load the format instead of re-reading the document
+    class and packages, which dominates their startup time.
+    Formats are kept under DISK_CACHE_DIR, keyed by the preamble and the
+    pdflatex binary, so each is built once rather than once per run (or per
+    pool worker); a failed build is remembered the same way, for
+    FALLBACK_FORMAT_RETRY seconds.
+    Returns the format name, or None if no format is available.
+    """
+    if preamble in _FALLBACK_FORMATS:
+        return _FALLBACK_FORMATS[preamble]
+
+    fmt_name = None
+    if config.DISK_CACHE:
+        try:
+            pdflatex = shutil.which("pdflatex")
+            key = repr((preamble, pdflatex, os.stat(pdflatex).st_mtime_ns))
+            name = "preamble-" + hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+            if os.path.exists(os.path.join(_format_dir(), name + ".fmt")):
+                fmt_name = name
+            elif not _format_failed_recently(name):
+                fmt_name = _build_fallback_format(preamble, name)
+        except (OSError, TypeError):
+            pass
+
+    _FALLBACK_FORMATS[preamble] = fmt_name
+    return fmt_name
+
+
+def _format_failed_recently(name):
+    try:
+        failed_at = os.stat(os.path.join(_format_dir(), name + ".failed")).st_mtime
+    except OSError:
+        return False
+    return time.time() - failed_at < FALLBACK_FORMAT_RETRY
+
+
+def _build_fallback_format(preamble, name):
+    """
+    Builds name.fmt in _format_dir(), or leaves a name.failed marker.
+    Built in a scratch directory and renamed into place, so concurrent runs
+    never load a partial format.
+    """
+    fmt_dir = _format_dir()
+    os.makedirs(fmt_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=fmt_dir) as build_dir:
+        with open(os.path.join(build_dir, name + ".tex"), "w", encoding="utf-8") as f:
+            f.write(preamble + "\\begin{document}\n\\end{document}\n")
+
+        subprocess.run(
+            ["pdflatex", "-ini", "-interaction=nonstopmode", f"-jobname={name}",
+             "&pdflatex", "mylatexformat.ltx", name + ".tex"],
+            cwd=build_dir, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        built = os.path.join(build_dir, name + ".fmt")
+        if os.path.exists(built):
+            os.replace(built, os.path.join(fmt_dir, name + ".fmt"))
+            return name
+
+    open(os.path.join(fmt_dir, name + ".failed"), "wb").close()
+    return None
+
+
+def _preview_page(final_latex, color_val):
+    """
+    One preview environment of the inline fallback document; with the preview
+    package active, each becomes its own tightly cropped PDF page.
+    """
+    return r"""\begin{preview}
+\definecolor{currcolor}{HTML}{%s}
+\color{currcolor}
+%s
+\end{preview}
+""" % (color_val, final_latex)
+
+
+def _run_pdflatex(tex_path, temp_dir, fmt_name):
+    """
+    Runs pdflatex on tex_path and returns the output PDF path, or None.
+    """
+    pdf_path = os.path.splitext(tex_path)[0] + ".pdf"
+    # Run pdflatex
+    # We allow it to fail (non-zero exit) as long as PDF is generated
+    # because of minor errors like undefined colors (which fallback to black) or font warnings.
+    # With a precompiled format the preamble is skipped; retry without it if that fails.
+    if fmt_name:
+        subprocess.run(
+            ["pdflatex", "-interaction=nonstopmode", f"-fmt={fmt_name}", "-output-directory", temp_dir, tex_path],
+            check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, TEXFORMATS=_format_dir() + os.pathsep)
+        )
+    if not os.path.exists(pdf_path):
+        subprocess.run(
+            ["pdflatex", "-interaction=nonstopmode", "-output-directory", temp_dir, tex_path],
+            check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    return pdf_path if os.path.exists(pdf_path) else None
+
+
+def _fallback_tools_available():
+    """
+    pdflatex plus a PDF rasterizer: poppler's pdftocairo, or ImageMagick's convert.
+    """
+    return bool(shutil.which("pdflatex") and (shutil.which("pdftocairo") or shutil.which("convert")))
+
+
+def _page_number(name):
+    return int(name.rsplit("-", 1)[1].split(".", 1)[0])
+
+
+def _fallback_preamble(preamble, padding):
+    """
+    Fills in the page border of a fallback preamble; padding is in inches.
+    """
+    return preamble % {"border": "%.4fin" % padding}
+
+
+def _rasterize_pdf(pdf_path, temp_dir, dpi):
+    """
+    Rasterizes every page of a PDF to a transparent PNG.
+    Prefers pdftocairo, which starts far faster than convert (no Ghostscript
+    delegate); convert is used when poppler is not installed.
+    Returns the PNG bytes in page order, or None if rasterizing failed.
+    """
+    prefix = os.path.join(temp_dir, "page")
+    if shutil.which("pdftocairo"):
+        # Writes page-1.png, page-2.png, ... (zero padded for longer documents)
+        cmd = ["pdftocairo", "-png", "-transparent", "-r", str(dpi), pdf_path, prefix]
+    else:
+        # Writes page-0.png, page-1.png, ...
+        cmd = ["convert", "-density", str(dpi), "-background", "none", pdf_path, prefix + "-%d.png"]
+
+    try:
+        subprocess.run(
+            cmd,
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
         return None
-    w, h = struct.unpack('>LL', data[16:24])
-    return w, h
+
+    names = sorted((n for n in os.listdir(temp_dir) if n.startswith("page-") and n.endswith(".png")), key=_page_number)
+    pages = []
+    for name in names:
+        with open(os.path.join(temp_dir, name), "rb") as f:
+            pages.append(f.read())
+    return pages or None
 
 
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
 def render_latex_fallback(latex_str, dpi=200, fontsize=14, color="#eeeeee", padding=0.0):
     """
-    Fallback rendering using system pdflatex and ImageMagick's convert.
+    Fallback rendering using system pdflatex and pdftocairo (or ImageMagick's convert).
     Used for complex LaTeX that Matplotlib cannot handle.
     """
-    if not shutil.which("pdflatex") or not shutil.which("convert"):
+    if not _fallback_tools_available():
         return None
 
     color_val = color.lstrip('#')
@@ -71,16 +358,8 @@ def render_latex_fallback(latex_str, dpi=200, fontsize=14, color="#eeeeee", padd
     
     # Check if this is a block environment (starts with \begin) or inline math
     if final_latex.strip().startswith(r'\begin{'):
-        # BLOCK MODE: Use 'standalone' with preview option.
-        # This matches the behavior of the "old working version" which handled flalign correctly.
-        tex_content = r"""
-\documentclass[preview]{standalone}
-\usepackage{amsmath}
-\usepackage{amssymb}
-\usepackage[dvipsnames,svgnames,x11names]{xcolor}
-\usepackage{graphicx}
-
-\begin{document}
+        preamble = _fallback_preamble(FALLBACK_BLOCK_PREAMBLE, padding)
+        body = r"""\begin{document}
 \fontsize{%f}{%f}\selectfont
 \definecolor{currcolor}{HTML}{%s}
 \color{currcolor}
@@ -88,148 +367,395 @@ def render_latex_fallback(latex_str, dpi=200, fontsize=14, color="#eeeeee", padd
 \end{document}
 """ % (fontsize, fontsize * 1.2, color_val, final_latex)
     else:
-        # INLINE MODE: Use 'article' + 'preview'.
-        # This is robust for long inline formulas and prevents them from wrapping.
-        # We explicitly set a huge paper width to effectively disable line breaking.
-        tex_content = r"""
-\documentclass{article}
-\usepackage{amsmath}
-\usepackage{amssymb}
-\usepackage[dvipsnames,svgnames,x11names]{xcolor}
-\usepackage{graphicx}
-\usepackage[active,tightpage]{preview}
-\setlength\PreviewBorder{0pt}
-
-\begin{document}
+        preamble = _fallback_preamble(FALLBACK_INLINE_PREAMBLE, padding)
+        body = r"""\begin{document}
 \fontsize{%f}{%f}\selectfont
-\begin{preview}
-\definecolor{currcolor}{HTML}{%s}
-\color{currcolor}
-%s
-\end{preview}
-\end{document}
-""" % (fontsize, fontsize * 1.2, color_val, final_latex)
+%s\end{document}
+""" % (fontsize, fontsize * 1.2, _preview_page(final_latex, color_val))
+    tex_content = preamble + body
+    fmt_name = _get_fallback_format(preamble)
 
     with tempfile.TemporaryDirectory() as temp_dir:
         tex_path = os.path.join(temp_dir, "equation.tex")
-        pdf_path = os.path.join(temp_dir, "equation.pdf")
-        png_path = os.path.join(temp_dir, "equation.png")
 
         with open(tex_path, "w", encoding="utf-8") as f:
             f.write(tex_content)
 
-        # Run pdflatex
-        # We allow it to fail (non-zero exit) as long as PDF is generated
-        # because of minor errors like undefined colors (which fallback to black) or font warnings.
-        subprocess.run(
-            ["pdflatex", "-interaction=nonstopmode", "-output-directory", temp_dir, tex_path],
-            check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        )
-
-        if not os.path.exists(pdf_path):
+        pdf_path = _run_pdflatex(tex_path, temp_dir, fmt_name)
+        if not pdf_path:
             return None
 
-        # Convert PDF to PNG
-        pad_px = int(padding * dpi)
-        cmd = ["convert", "-density", str(dpi), "-background", "none"]
-        if pad_px > 0:
-            cmd.extend(["-bordercolor", "none", "-border", str(pad_px)])
-        cmd.extend([pdf_path, png_path])
+        # Convert PDF to PNG; a single equation must give a single page
+        pages = _rasterize_pdf(pdf_path, temp_dir, dpi)
+        if pages and len(pages) == 1:
+            return pages[0]
+    return None
 
-        try:
-            subprocess.run(
-                cmd,
-                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-            )
-        except subprocess.CalledProcessError:
-            return None
 
-        if os.path.exists(png_path):
-            with open(png_path, "rb") as f:
-                return f.read()
-    return None
+def fallback_batches(jobs):
+    """
+    Groups the equations that need the pdflatex fallback (see
+    requires_system_fallback) by render settings. Each group is typeset in one
+    pdflatex run and rasterized in one pdftocairo (or convert) run, one PDF page
+    per equation, instead of two processes per equation.
+    Returns a list of _render_fallback_pages argument tuples, each with at most
+    BATCH_RENDER_SIZE equations.
+    """
+    if not _fallback_tools_available():
+        return []
+
+    groups = {}
+    for job in dict.fromkeys(jobs):
+        latex_str = job[0]
+        if not requires_system_fallback(latex_str):
+            continue
+        final_latex = sanitize_for_fallback(latex_str)
+        # Environments use the standalone block preamble; they stay per-equation
+        if final_latex.strip().startswith(r'\begin{'):
+            continue
+        groups.setdefault(job[1:], []).append((job, final_latex))
+
+    return [(group[start:start + BATCH_RENDER_SIZE], *settings)
+            for settings, group in groups.items()
+            for start in range(0, len(group), BATCH_RENDER_SIZE)]
+
+
+def render_fallback_batched(batches):
+    """
+    Renders fallback_batches in this process.
+    Returns {job: RenderResult}; jobs missing from the result are rendered on demand.
+    """
+    rendered = {}
+    for args in batches:
+        rendered.update(_render_fallback_pages(*args))
+    return rendered
 
 
-def render_latex_to_png(latex_str, dpi=200, fontsize=14, color="#eeeeee", padding=0.0):
-    buf = io.BytesIO()
+def _render_fallback_pages(group, dpi, fontsize, color, padding):
+    color_val = color.lstrip('#')
+    pages = "".join(_preview_page(final_latex, color_val) for _, final_latex in group)
+    preamble = _fallback_preamble(FALLBACK_INLINE_PREAMBLE, padding)
+    tex_content = preamble + r"""\begin{document}
+\fontsize{%f}{%f}\selectfont
+%s\end{document}
+""" % (fontsize, fontsize * 1.2, pages)
+    fmt_name = _get_fallback_format(preamble)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tex_path = os.path.join(temp_dir, "equations.tex")
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write(tex_content)
 
-    # Create figure
-    fig = plt.figure(figsize=(0.01, 0.01), dpi=dpi)
+        pdf_path = _run_pdflatex(tex_path, temp_dir, fmt_name)
+        pages = _rasterize_pdf(pdf_path, temp_dir, dpi) if pdf_path else None
+        # A page count that doesn't match means an equation was lost or split;
+        # pages can't be matched to equations, so render them one by one instead.
+        if not pages or len(pages) != len(group):
+            return {}
 
-    # Add text
-    text = fig.text(
-        0.5, 0.5, latex_str, fontsize=fontsize, color=color, ha="center", va="center"
-    )
+        rendered = {}
+        for (job, _), png_bytes in zip(group, pages):
+            size = get_png_dimensions(png_bytes)
+            if size:
+                rendered[job] = RenderResult(png_bytes, *size)
+                _disk_cache_store(job, png_bytes)
+        return rendered
+
+
+@functools.lru_cache(maxsize=None)
+def _load_glyph_font(italic, size_px):
+    """
+    Loads the STIX font used by mathtext for single-glyph renders, or None if unavailable.
+    """
+    try:
+        prop = font_manager.FontProperties(family="STIXGeneral", style="italic" if italic else "normal")
+        path = font_manager.findfont(prop, fallback_to_default=False)
+        return ImageFont.truetype(path, size_px)
+    except Exception:
+        return None
+
+
+def render_single_glyph(latex_str, dpi=200, fontsize=14, color="#eeeeee", padding=0.0):
+    """
+    Fast path for formulas that are a single glyph or a plain number ($x$, $\\alpha$, $42$):
+    draws the STIX glyphs directly with Pillow instead of running mathtext.
+    Returns None when the formula is not that simple.
+    """
+    if not config.FAST_SINGLE_GLYPH or matplotlib.rcParams["mathtext.fontset"] != "stix":
+        return None
+
+    glyph = single_glyph(latex_str)
+    if glyph is None:
+        return None
+
+    text, italic = glyph
+    font = _load_glyph_font(italic, max(1, round(fontsize * dpi / 72)))
+    if font is None:
+        return None
+
+    # Ink box relative to the baseline (top is negative above it)
+    left, top, right, bottom = font.getbbox(text, anchor="ls")
+    if right <= left or bottom <= top:
+        return None
+
+    # Cropped to the ink horizontally only: vertically the canvas spans the
+    # same line box as mathtext renders, so the baseline lines up with them
+    line_ascent, line_descent = _line_metrics(dpi, fontsize)
+    ascent = max(-top, line_ascent)
+    descent = max(bottom, line_descent)
+    pad_px = padding * dpi
+    canvas_w = int(right - left + 2 * pad_px)
+    canvas_h = int(ascent + descent + 2 * pad_px)
+    # Truncated: Pillow would round, which sits a pixel below mathtext's glyphs
+    baseline = int((canvas_h - ascent - descent) / 2 + ascent)
+    img = Image.new("RGBA", (canvas_w, canvas_h), (0, 0, 0, 0))
+    ImageDraw.Draw(img).text(((canvas_w - right - left) / 2, baseline), text, font=font, fill=color, anchor="ls")
+
+    buf = _png_buffer()
+    img.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+
+def _png_buffer():
+    """
+    Returns the shared PNG output buffer, emptied.
+    Renders run one at a time per process, so a single buffer is reused
+    instead of allocating a new BytesIO for every equation.
+    """
+    _PNG_BUF.seek(0)
+    _PNG_BUF.truncate()
+    return _PNG_BUF
+
+
+@functools.lru_cache(maxsize=None)
+def _measuring_renderer(dpi):
+    """
+    Returns a 1x1 Agg renderer at dpi, used only to measure text.
+    """
+    return RendererAgg(1, 1, dpi)
+
+
+@functools.lru_cache(maxsize=None)
+def _line_metrics(dpi, fontsize):
+    """
+    Returns the line (ascent, descent) in pixels of the text font, from its
+    OS/2 or hhea table as Matplotlib lays out text. Renders are at least this
+    tall, so short formulas all share one height and baseline.
+    """
+    prop = font_manager.FontProperties(size=fontsize)
+    font = font_manager.get_font(font_manager.findfont(prop))
+    scale = fontsize * dpi / 72 / font.units_per_EM
+    os2 = font.get_sfnt_table("OS/2")
+    if os2 is not None:
+        return os2["sTypoAscender"] * scale, -os2["sTypoDescender"] * scale
+    return font.ascender * scale, -font.descender * scale
+
+
+def render_mathtext_direct(latex_str, dpi=200, fontsize=14, color="#eeeeee", padding=0.0):
+    """
+    Draws a formula straight onto an Agg renderer sized to its line box,
+    skipping the figure, the text artist and its layout pass. The box reaches
+    at least the font's line ascent and descent (see _line_metrics).
+    Returns None when it fails, so the figure path (and its fallbacks) runs.
+    """
+    if not config.DIRECT_MATHTEXT:
+        return None
+    prop = font_manager.FontProperties(size=fontsize)
+    try:
+        measuring = _measuring_renderer(dpi)
+        width, height, depth = measuring.get_text_width_height_descent(latex_str, prop, ismath=True)
+        line_ascent, line_descent = _line_metrics(dpi, fontsize)
+        ascent = max(height - depth, line_ascent)
+        descent = max(depth, line_descent)
+
+        pad_px = padding * dpi
+        canvas_w = int(width + 2 * pad_px)
+        canvas_h = int(ascent + descent + 2 * pad_px)
+        renderer = RendererAgg(canvas_w, canvas_h, dpi)
+        # Share the measuring parser, so drawing hits the parse it just cached
+        renderer.mathtext_parser = measuring.mathtext_parser
+        gc = renderer.new_gc()
+        gc.set_foreground(color)
+        # Centered like the text artist; y is the baseline, downwards
+        renderer.draw_text(gc, (canvas_w - width) / 2, (canvas_h - ascent - descent) / 2 + ascent,
+                           latex_str, prop, 0, ismath=True)
+        gc.restore()
+    except Exception:
+        return None
+
+    img = Image.frombuffer("RGBA", (canvas_w, canvas_h), renderer.buffer_rgba(), "raw", "RGBA", 0, 1)
+    buf = _png_buffer()
+    img.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+
+def _get_text_artist(dpi):
+    """
+    Returns the shared text artist used for Matplotlib renders.
+    The figure is created once and reused, since building and closing a
+    figure per equation costs more than drawing a few glyphs.
+    """
+    # Kept per DPI so alternating inline and block renders at different
+    # resolutions don't rescale one figure back and forth.
+    text = _TEXT_ARTISTS.get(dpi)
+    if text is None:
+        fig = Figure(figsize=(0.01, 0.01), dpi=dpi)
+        FigureCanvas(fig)
+        # Transparent once here, so saving can go straight to the canvas
+        fig.patch.set_alpha(0)
+        text = _TEXT_ARTISTS[dpi] = fig.text(0.5, 0.5, "", ha="center", va="center")
+    return text
+
+
+def _save_fitted(buf, text, dpi, padding):
+    """
+    Saves the shared figure resized to exactly the text extent plus padding.
+    Measuring the text once replaces bbox_inches="tight", which draws the figure twice,
+    and printing from the canvas skips savefig's per-call format and style setup.
+    """
+    fig = text.figure
+    bbox = text.get_window_extent(renderer=fig.canvas.get_renderer())
+    fig.set_size_inches(bbox.width / dpi + 2 * padding, bbox.height / dpi + 2 * padding)
+    if isinstance(fig.canvas, FigureCanvasAgg):
+        fig.canvas.print_png(buf, pil_kwargs={"compress_level": PNG_COMPRESS_LEVEL})
+    else:
+        fig.canvas.print_png(buf)  # mplcairo encodes with its own settings
+
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_latex_to_png(latex_str, dpi=200, fontsize=14, color="#eeeeee", padding=0.0):
+    _init_matplotlib()
+
+    glyph_png = render_single_glyph(latex_str, dpi, fontsize, color, padding)
+    if glyph_png:
+        return glyph_png
 
     # Check for symbols known to be problematic in Matplotlib (clipping issues)
-    # and force fallback if system tools are available.
+    # and force fallback if system tools are available, before touching the figure.
     if requires_system_fallback(latex_str):
         fallback = render_latex_fallback(latex_str, dpi, fontsize, color, padding)
         if fallback:
-             plt.close(fig)
-             buf.close()
-             return fallback
+            return fallback
+
+    direct_png = render_mathtext_direct(latex_str, dpi, fontsize, color, padding)
+    if direct_png:
+        return direct_png
+
+    buf = _png_buffer()
+
+    # Reuse the shared figure, only updating the text artist
+    text = _get_text_artist(dpi)
+    text.set_text(latex_str)
+    text.set_fontsize(fontsize)
+    text.set_color(color)
 
     try:
-        fig.savefig(
-            buf,
-            format="png",
-            dpi=dpi,
-            transparent=True,
-            bbox_inches="tight",
-            pad_inches=padding,
-        )
+        _save_fitted(buf, text, dpi, padding)
     except Exception:
         # Fallback 1: System LaTeX
         fallback = render_latex_fallback(latex_str, dpi, fontsize, color, padding)
         if fallback:
-            plt.close(fig)
             return fallback
 
         # Fallback 2: Dejavu Sans (for simple missing symbols in MPL)
         try:
-            plt.close(fig)
-            matplotlib.rcParams["mathtext.fontset"] = "dejavusans"
-            fig = plt.figure(figsize=(0.01, 0.01), dpi=dpi)
-            fig.text(0.5, 0.5, latex_str, fontsize=fontsize, color=color, ha="center", va="center")
-            buf = io.BytesIO()
-            fig.savefig(buf, format="png", dpi=dpi, transparent=True, bbox_inches="tight", pad_inches=padding)
-            matplotlib.rcParams["mathtext.fontset"] = "stix"
+            text.set_math_fontfamily("dejavusans")
+            buf = _png_buffer()
+            _save_fitted(buf, text, dpi, padding)
         except Exception:
             return None
-    finally:
-        plt.close(fig)
+        finally:
+            text.set_math_fontfamily(matplotlib.rcParams["mathtext.fontset"])
 
-    buf.seek(0)
     return buf.getvalue()
 
 
 def serialize_gr_command(cmd, payload=None):
-    cmd_str = ",".join(f"{k}={v}" for k, v in cmd.items())
+    """
+    Builds a Kitty graphics protocol escape sequence.
+    Returns bytes (ASCII) with or without a payload.
+    """
+    # Keys and values are ASCII; format them as one string and encode once
+    cmd_bytes = ",".join(f"{k}={v}" for k, v in cmd.items()).encode("ascii")
+    ST = b"\x1b\\"
 
     if payload:
-        b64_data = base64.standard_b64encode(payload)
-        output = []
-        while len(b64_data) > 0:
-            chunk = b64_data[:CHUNK_SIZE]
-            b64_data = b64_data[CHUNK_SIZE:]
-            m_val = 1 if len(b64_data) > 0 else 0
-            header = f"m={m_val};" if output else f"{cmd_str},m={m_val};"
-            chunk_str = chunk.decode("ascii")
-            ST = chr(27) + chr(92)
-            output.append("\x1b_G" + header + chunk_str + ST)
-        return "".join(output)
+        # Encode the payload one chunk at a time: RAW_CHUNK_SIZE source bytes
+        # become exactly CHUNK_SIZE base64 characters, so no large base64
+        # buffer is built and then repeatedly re-sliced.
+        # Slicing a memoryview is zero-copy; the encoder reads it in place.
+        # Each piece is appended straight into one output buffer, so chunks
+        # are never concatenated into intermediate strings or joined at the end;
+        # the finished buffer is copied out once.
+        view = memoryview(payload)
+        total = len(view)
+        output = bytearray()
+        for start in range(0, total, RAW_CHUNK_SIZE):
+            end = start + RAW_CHUNK_SIZE
+            # Only the first chunk carries the command keys; later ones just m=
+            if start == 0:
+                output += b"\x1b_G"
+                output += cmd_bytes
+                output += b",m="
+            else:
+                output += b"\x1b_Gm="
+            output += b"1;" if end < total else b"0;"
+            output += standard_b64encode(view[start:end])
+            output += ST
+        return bytes(output)
     else:
-        ST = chr(27) + chr(92)
-        return f"\x1b_G{cmd_str};{ST}"
+        return b"\x1b_G" + cmd_bytes + b";" + ST
 
 
-def display_image_kitty(png_bytes, inline=False, cell_h=20, cols=None, rows=None, y_offset=0, cell_w=10):
-    if not png_bytes:
-        return ("", 0) if not inline else ""
+def _kitty_image_id_base():
+    """
+    Returns the first Kitty image id for this process. Ids are random per run so
+    they don't replace images an earlier run left on screen or in scrollback.
+    """
+    global _KITTY_IMAGE_ID_BASE
+    if _KITTY_IMAGE_ID_BASE is None:
+        # Kitty ids are 32-bit and nonzero; leave room to count up from the base
+        _KITTY_IMAGE_ID_BASE = (int.from_bytes(os.urandom(4), "big") >> 1) + 1
+    return _KITTY_IMAGE_ID_BASE
 
-    w, h = get_png_dimensions(png_bytes)
-    cmd = {"a": "T", "f": "100", "C": "1"}
+
+def _kitty_image_reuse(cmd, png_bytes):
+    """
+    Returns the (command, payload) that shows png_bytes: a bare placement of the
+    stored image if it was transmitted recently, otherwise cmd with a new id so
+    later uses can refer to it.
+    """
+    global _KITTY_IMAGE_IDS, _KITTY_IMAGE_COUNT
+    key = hashlib.blake2b(png_bytes, digest_size=8).digest()
+    image_id = _KITTY_IMAGE_IDS.get(key)
+    base = _kitty_image_id_base()
+    if image_id is not None and base + _KITTY_IMAGE_COUNT - image_id <= KITTY_IMAGE_REUSE_LIMIT:
+        # Still stored by the terminal: place it again without the data
+        return {"a": "p", "i": image_id, "C": "1", "q": "2"}, None
+
+    # A new id rather than the old one: retransmitting under an id replaces the
+    # image, taking its placements already on screen with it
+    image_id = base + _KITTY_IMAGE_COUNT
+    _KITTY_IMAGE_COUNT += 1
+    _KITTY_IMAGE_IDS[key] = image_id
+    if len(_KITTY_IMAGE_IDS) > 2 * KITTY_IMAGE_REUSE_LIMIT:
+        # Keep only the ids that can still be placed
+        oldest = base + _KITTY_IMAGE_COUNT - KITTY_IMAGE_REUSE_LIMIT
+        _KITTY_IMAGE_IDS = {k: i for k, i in _KITTY_IMAGE_IDS.items() if i >= oldest}
+    return dict(cmd, i=image_id), png_bytes
+
+
+def display_image_kitty(png_bytes, inline=False, cell_h=20, cols=None, rows=None, y_offset=0, cell_w=10, size=None):
+    if not png_bytes:
+        return (b"", 0) if not inline else b""
+
+    # Callers that already parsed the PNG header pass (w, h) as size
+    w, h = size or get_png_dimensions(png_bytes)
+    # q=2: the terminal sends no responses; nothing here reads them back
+    cmd = {"a": "T", "f": "100", "C": "1", "q": "2"}
+    payload = png_bytes
+    if config.KITTY_IMAGE_REUSE:
+        cmd, payload = _kitty_image_reuse(cmd, png_bytes)
     
     # Calculate dimensions
     rows_needed = 0
@@ -246,30 +772,438 @@ def display_image_kitty(png_bytes, inline=False, cell_h=20, cols=None, rows=None
             # Scale factor = (target_cols * cell_w) / img_w
             
             # If we are scaling UP or DOWN to fit a specific column width:
+            # rows = ceil(h * scale / cell_h), kept in integers
             target_px_w = cols * cell_w
-            scale = target_px_w / w
-            scaled_h = h * scale
-            rows_needed = max(1, math.ceil(scaled_h / cell_h))
+            rows_needed = max(1, ceil_div(h * target_px_w, w * cell_h))
         else:
             # Native size
-            rows_needed = max(1, math.ceil(h / cell_h))
+            rows_needed = max(1, ceil_div(h, cell_h))
 
     if rows is not None: cmd["r"] = rows
     if y_offset != 0: cmd["Y"] = int(y_offset)
 
     if inline:
-        return serialize_gr_command(cmd, png_bytes)
+        return serialize_gr_command(cmd, payload)
     else:
-        return serialize_gr_command(cmd, png_bytes), rows_needed
+        return serialize_gr_command(cmd, payload), rows_needed
 
 
 def parse_input(text):
-    pattern = r"(\$\$.*?\$\$|\$(?!\\$).*?\$)"
-    parts = re.split(pattern, text, flags=re.DOTALL)
-    return [p for p in parts if p]
+    """
+    Splits text into plain text, block math ($$...$$) and inline math ($...$) segments.
+    Single linear scan: str.find jumps between '$' delimiters, so there is no
+    regex backtracking on long inputs.
+    """
+    return scan_segments(text)[0]
+
+
+def scan_segments(text, final=True):
+    """
+    The parse_input scanner. With final=False, text is a prefix of the input
+    and scanning stops before the first delimiter whose meaning could still
+    change once more text arrives (an unclosed $ or $$, or a trailing $ that
+    may start a $$).
+    Returns (segments, consumed): the segments for text[:consumed].
+    """
+    parts = []
+    start = 0
+    i = text.find('$')
+    while i != -1:
+        if not final and i == len(text) - 1:
+            break
+        end = -1
+        # Block math takes precedence when a closing $$ exists
+        if text.startswith('$$', i):
+            close = text.find('$$', i + 2)
+            if close != -1:
+                end = close + 2
+            elif not final:
+                break
+        if end == -1:
+            close = text.find('$', i + 1)
+            if close == -1:
+                break
+            end = close + 1
+
+        if i > start:
+            parts.append(text[start:i])
+        parts.append(text[i:end])
+        start = end
+        i = text.find('$', start)
+
+    stop = len(text) if final or i == -1 else i
+    if start < stop:
+        parts.append(text[start:stop])
+    return parts, stop
+
+
+def iter_stream_segments(stream):
+    """
+    Reads a binary stream (piped stdin) in chunks and yields lists of segments
+    as soon as they are delimited, so output starts before the input ends and
+    only the undelimited tail is kept in memory. Decodes like text-mode stdin
+    (locale encoding, universal newlines), including across chunk boundaries.
+    """
+    decoder = codecs.getincrementaldecoder(sys.stdin.encoding or "utf-8")(sys.stdin.errors or "strict")
+    decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+    read = getattr(stream, "read1", stream.read)
+
+    # A non-empty pending starts with a $ or $$ that could not be closed yet;
+    # text read after it is held until a $ arrives that might close it, so a
+    # stray $ does not make every later chunk rescan (and copy) all of pending
+    pending = ""
+    held = []
+    while True:
+        chunk = read(STDIN_CHUNK_SIZE)
+        final = not chunk
+        held.append(decoder.decode(chunk, final=final))
+        if pending and not final and "$" not in held[-1]:
+            continue
+        pending = "".join([pending] + held)
+        held = []
+        segments, consumed = scan_segments(pending, final)
+        pending = pending[consumed:]
+        if segments:
+            yield segments
+        if final:
+            return
+
+
+def is_block_math(seg):
+    return seg.startswith("$$") and seg.endswith("$$") and len(seg) > 4
+
+
+def is_inline_math(seg):
+    return seg.startswith("$") and seg.endswith("$") and len(seg) > 2
+
+
+@functools.lru_cache(maxsize=None)
+def inline_math_style(cell_h):
+    """
+    Returns the (dpi, fontsize, color, padding) render arguments shared by every
+    inline equation at the given line height. Computed once instead of re-reading
+    config and redoing the font size arithmetic per equation.
+    """
+    target_dpi = config.INLINE_MATH_DPI
+    target_fontsize = (cell_h * config.INLINE_MATH_SCALE_FACTOR * 72) / target_dpi
+    # Rounded to 0.5pt so nearby line heights share render cache entries
+    # (memory and disk); at most 0.25pt off, about a pixel at typical sizes.
+    target_fontsize = round(target_fontsize * 2) / 2
+    return (target_dpi, target_fontsize, "#eeeeee", config.INLINE_MATH_PADDING)
+
+
+@functools.lru_cache(maxsize=None)
+def block_math_style():
+    """
+    Returns the (dpi, fontsize, color, padding) render arguments for block equations.
+    """
+    return (config.BLOCK_MATH_DPI, config.BLOCK_MATH_FONT_SIZE, "#eeeeee", config.BLOCK_MATH_PADDING)
+
+
+def inline_math_job(content, cell_h):
+    """
+    Returns the render_latex_to_png arguments for an inline math segment ($...$),
+    scaled to the terminal line height.
+    """
+    # Sanitize content inside the delimiters
+    clean_math = sanitize_latex(content[1:-1])
+    return (f"${clean_math}$",) + inline_math_style(cell_h)
+
+
+def block_math_job(seg):
+    """
+    Returns the render_latex_to_png arguments for a block math segment ($$...$$).
+    """
+    clean_content = sanitize_latex(seg[2:-2])
+    return (f"${clean_content}$",) + block_math_style()
+
+
+@functools.lru_cache(maxsize=1)
+def _disk_cache_salt():
+    """
+    Returns what besides the job decides how it renders, for the disk cache key:
+    the rendering switches in config, the installed libraries and the fallback
+    tools on PATH. Libraries are identified by their package file's path and
+    mtime, which change on upgrade; unlike importing them (or reading package
+    metadata), that costs microseconds, so cache hits stay cheap.
+    """
+    def installed(name):
+        try:
+            origin = importlib.util.find_spec(name).origin
+            return origin, os.stat(origin).st_mtime_ns
+        except (AttributeError, ImportError, TypeError, ValueError, OSError):
+            return None
+
+    return (
+        DISK_CACHE_VERSION,
+        config.DIRECT_MATHTEXT,
+        config.FAST_SINGLE_GLYPH,
+        config.USE_MPLCAIRO and installed("mplcairo"),
+        installed("matplotlib"),
+        installed("PIL"),
+        tuple(shutil.which(tool) is not None for tool in ("pdflatex", "pdftocairo", "convert")),
+    )
+
+
+def _disk_cache_path(job):
+    key = hashlib.blake2b(repr((_disk_cache_salt(), job)).encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(config.DISK_CACHE_DIR, key + ".png")
+
+
+def _disk_cache_load(job):
+    """
+    Returns the PNG stored on disk for a job, or None.
+    A file that is not a PNG (truncated or corrupted) is removed, so the job is
+    rendered again and the entry rewritten.
+    """
+    if not config.DISK_CACHE:
+        return None
+    path = _disk_cache_path(job)
+    try:
+        with open(path, "rb") as f:
+            png_bytes = f.read()
+    except OSError:
+        return None
+    if get_png_dimensions(png_bytes) is None:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    try:
+        # Marks the entry as recently used for _prune_disk_cache; atime can't
+        # be relied on (noatime and relatime mounts)
+        os.utime(path)
+    except OSError:
+        pass
+    return png_bytes
 
 
-def print_buffered_line(line_buffer, cell_w, cell_h):
+def _disk_cache_store(job, png_bytes):
+    """
+    Stores a rendered PNG on disk. Written to a temporary file and renamed into
+    place so concurrent runs (or pool workers) never read a partial image.
+    """
+    if not config.DISK_CACHE:
+        return
+    try:
+        os.makedirs(config.DISK_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=config.DISK_CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(png_bytes)
+            os.replace(tmp_path, _disk_cache_path(job))
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass
+
+
+def _prune_disk_cache():
+    """
+    Removes the least recently used PNGs once the cache exceeds DISK_CACHE_MAX_MB.
+    Entries are ordered by mtime, which _disk_cache_load refreshes on every hit.
+    """
+    try:
+        with os.scandir(config.DISK_CACHE_DIR) as it:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in it if e.name.endswith(".png")]
+    except OSError:
+        return
+
+    excess = sum(size for _, size, _ in entries) - config.DISK_CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if excess <= 0:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        excess -= size
+
+
+def load_cached_renders(jobs):
+    """
+    Returns {job: RenderResult} for every job already in the on-disk cache.
+    """
+    if not config.DISK_CACHE:
+        return {}
+    rendered = {}
+    for job in dict.fromkeys(jobs):
+        png_bytes = _disk_cache_load(job)
+        size = get_png_dimensions(png_bytes) if png_bytes else None
+        if size:
+            rendered[job] = RenderResult(png_bytes, *size)
+    return rendered
+
+
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render_with_size(job):
+    """
+    Renders a job and parses the PNG size once; cache hits return both.
+    Checks the on-disk cache first and adds new renders to it.
+    """
+    png_bytes = _disk_cache_load(job)
+    if png_bytes is None:
+        png_bytes = render_latex_to_png(*job)
+        if png_bytes:
+            _disk_cache_store(job, png_bytes)
+    if not png_bytes:
+        return RenderResult(None, 0, 0)
+    return RenderResult(png_bytes, *get_png_dimensions(png_bytes))
+
+
+def render_jobs_parallel(jobs, batches=()):
+    """
+    Starts rendering independent equations across a process pool, along with
+    the pdflatex batches from fallback_batches (one task each).
+    Returns {job: Future}, submitted in document order so the first lines can be
+    written while later equations are still rendering; jobs missing from the
+    result are rendered on demand. Futures resolve to a RenderResult, or to
+    None for an equation its pdflatex batch could not render.
+    The pool is started once and reused for later batches of streamed input.
+    """
+    global _RENDER_POOL
+    unique_jobs = list(dict.fromkeys(jobs))
+    count = len(unique_jobs) + sum(len(args[0]) for args in batches)
+    if not config.PARALLEL_RENDER or not count:
+        return {}
+
+    if _RENDER_POOL is None:
+        workers = os.cpu_count() or 1
+        if count < config.PARALLEL_RENDER_MIN_EQUATIONS or workers < 2:
+            return {}
+
+        # Imported here: multiprocessing adds ~15 ms to startup for documents
+        # that never reach the pool (plain text, or only a few equations)
+        from concurrent.futures import ProcessPoolExecutor
+        try:
+            # Default start method: under forkserver (Linux, Python 3.14+) or
+            # spawn (macOS) workers start on demand and each re-imports this
+            # module and Matplotlib (~0.4 s); under fork (older Linux) all start
+            # at the first submit and inherit what this process has imported
+            _RENDER_POOL = ProcessPoolExecutor(max_workers=workers)
+        except Exception:
+            # e.g. no multiprocessing support (sandboxes, missing /dev/shm); render sequentially
+            return {}
+
+    try:
+        rendered = {}
+        # The pdflatex batches are the longest tasks: queued first, one worker
+        # runs them while the others work through the equations below
+        for args in batches:
+            rendered.update(_submit_fallback_batch(args))
+        rendered.update((job, _RENDER_POOL.submit(_render_with_size, job)) for job in unique_jobs)
+        return rendered
+    except Exception:
+        # The pool broke (a worker was killed); render sequentially from here on
+        return {}
+
+
+def _submit_fallback_batch(args):
+    """
+    Submits one pdflatex batch to the pool. Returns {job: Future} with one
+    future per equation, resolved from the batch's result when it finishes.
+    """
+    from concurrent.futures import Future
+    futures = {job: Future() for job, _ in args[0]}
+
+    def distribute(batch):
+        try:
+            results = batch.result()
+        except Exception:
+            results = {}
+        for job, future in futures.items():
+            future.set_result(results.get(job))
+
+    _RENDER_POOL.submit(_render_fallback_pages, *args).add_done_callback(distribute)
+    return futures
+
+
+def shutdown_render_pool():
+    """
+    Lets the workers exit once their submitted jobs are done.
+    """
+    global _RENDER_POOL
+    if _RENDER_POOL is not None:
+        _RENDER_POOL.shutdown(wait=False)
+        _RENDER_POOL = None
+
+
+def render_segments(segments, cell_h):
+    """
+    Renders every equation among segments up front: from the disk cache, then
+    the process pool, which also runs the batched pdflatex fallback. Without
+    the pool the pdflatex batches run here and the rest renders on demand.
+    Returns {job: RenderResult or Future} for render_job.
+    """
+    global _DISK_CACHE_PRUNE_SCHEDULED
+    jobs = []
+    for seg in segments:
+        if is_block_math(seg):
+            jobs.append(block_math_job(seg))
+        elif is_inline_math(seg):
+            jobs.append(inline_math_job(seg, cell_h))
+
+    rendered = load_cached_renders(jobs)
+    pending = [job for job in jobs if job not in rendered]
+    if pending and config.DISK_CACHE and not _DISK_CACHE_PRUNE_SCHEDULED:
+        # New renders are stored as they finish (also by pool workers); trim once at exit
+        _DISK_CACHE_PRUNE_SCHEDULED = True
+        atexit.register(_prune_disk_cache)
+    batches = fallback_batches(pending)
+    batched = {job for group, *_ in batches for job, _ in group}
+    pending = [job for job in pending if job not in batched]
+    rendered.update(render_jobs_parallel(pending, batches) or render_fallback_batched(batches))
+    return rendered
+
+
+def render_job(job, rendered=None, out=None):
+    """
+    Returns the RenderResult for a job, preferring results rendered up front
+    (waiting for it if it is still rendering in the process pool).
+    Output collected in out is written before waiting, so the lines already
+    finished are shown while later equations render.
+    """
+    result = rendered.get(job) if rendered else None
+    if result is not None and not isinstance(result, RenderResult):
+        if out and not result.done():
+            write_output(out)
+            del out[:]
+        try:
+            result = result.result()
+        except Exception:
+            # The worker died (or the pool never started); render it here instead
+            result = None
+    if result is None:
+        return _render_with_size(job)
+    return result
+
+
+def write_output(data):
+    """
+    Writes already-encoded output straight to the stdout file descriptor,
+    bypassing the text and buffered I/O layers.
+    """
+    sys.stdout.flush()
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, OSError):
+        # Not backed by a real file (e.g. replaced stdout); use the buffer API
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+        return
+
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def print_buffered_line(line_buffer, cell_w, cell_h, rendered=None, out=None):
+    """
+    Emits one line of text and inline equations. When out is given the bytes
+    are appended to it for the caller to write; otherwise they are written now.
+    """
     if not line_buffer:
         return
 
@@ -284,43 +1218,30 @@ def print_buffered_line(line_buffer, cell_w, cell_h):
 
         elif item_type == 'math':
             has_math = True
-            scale_factor = config.INLINE_MATH_SCALE_FACTOR
-            target_dpi = config.INLINE_MATH_DPI
-            target_fontsize = (cell_h * scale_factor * 72) / target_dpi
-
-            # Sanitize content inside the delimiters
-            inner_math = content[1:-1]
-            clean_math = sanitize_latex(inner_math)
-            latex_wrapped = f"${clean_math}$"
-
-            png_bytes = render_latex_to_png(
-                latex_wrapped, dpi=target_dpi, fontsize=target_fontsize,
-                color="#eeeeee", padding=config.INLINE_MATH_PADDING
-            )
+            png_bytes, w, h = render_job(inline_math_job(content, cell_h), rendered, out)
 
             if png_bytes:
-                w, h = get_png_dimensions(png_bytes)
                 y_offset = (cell_h - h) // 2
-                overflow_threshold = cell_h * 0.2
 
                 rows_up = 0
                 if y_offset < 0:
                     abs_overflow_up = abs(y_offset)
-                    if abs_overflow_up > overflow_threshold:
-                        rows_up = math.ceil(abs_overflow_up / cell_h)
+                    # Overflow beyond 20% of the line height needs extra rows (5 * px > cell_h)
+                    if 5 * abs_overflow_up > cell_h:
+                        rows_up = ceil_div(abs_overflow_up, cell_h)
 
                 bottom_y = h + y_offset
                 rows_down = 0
                 if bottom_y > cell_h:
                     overflow_down = bottom_y - cell_h
-                    if overflow_down > overflow_threshold:
-                        rows_down = math.ceil(overflow_down / cell_h)
+                    if 5 * overflow_down > cell_h:
+                        rows_down = ceil_div(overflow_down, cell_h)
 
                 max_rows_up = max(max_rows_up, rows_up)
                 max_rows_down = max(max_rows_down, rows_down)
 
                 rendered_items.append({
-                    'type': 'math', 'png': png_bytes, 'w': w, 'y_offset': y_offset
+                    'type': 'math', 'png': png_bytes, 'w': w, 'h': h, 'y_offset': y_offset
                 })
             else:
                 rendered_items.append({'type': 'text', 'content': content})
@@ -329,39 +1250,45 @@ def print_buffered_line(line_buffer, cell_w, cell_h):
         max_rows_up += config.INLINE_MATH_MARGIN_TOP
         max_rows_down += config.INLINE_MATH_MARGIN_BOTTOM
 
+    # Build the whole line (text, cursor moves, image data) and write it once
+    pending = out
+    out = bytearray() if pending is None else pending
     if max_rows_up > 0:
-        sys.stdout.write('\n' * max_rows_up)
+        out += b"\n" * max_rows_up
 
     for item in rendered_items:
         if item['type'] == 'text':
-            sys.stdout.write(item['content'])
+            out += item['content'].encode("utf-8")
         elif item['type'] == 'math':
             w = item['w']
+            h = item['h']
             png = item['png']
             y_offset = item['y_offset']
-            num_spaces = int(w / cell_w) + 1
-            spaces = " " * num_spaces
+            num_spaces = w // cell_w + 1
 
-            sys.stdout.write(spaces)
-            sys.stdout.write(f"\033[{num_spaces}D")
+            # The spaces go first: terminals that keep images as cell attributes
+            # (WezTerm) would erase an image printed over by them afterwards
+            out += b" " * num_spaces
+            out += CURSOR_BACK % num_spaces
 
             if y_offset < 0:
-                rows_up_cmd = math.ceil(-y_offset / cell_h)
+                rows_up_cmd = ceil_div(-y_offset, cell_h)
                 final_y_offset = y_offset + (rows_up_cmd * cell_h)
-                sys.stdout.write("\0337")
-                sys.stdout.write(f"\033[{rows_up_cmd}A")
-                sys.stdout.write(display_image_kitty(png, inline=True, cell_h=cell_h, y_offset=final_y_offset, cell_w=cell_w))
-                sys.stdout.write("\0338")
+                out += b"\0337"
+                out += CURSOR_UP % rows_up_cmd
+                out += display_image_kitty(png, inline=True, cell_h=cell_h, y_offset=final_y_offset, cell_w=cell_w, size=(w, h))
+                out += b"\0338"
             else:
-                sys.stdout.write(display_image_kitty(png, inline=True, cell_h=cell_h, y_offset=y_offset, cell_w=cell_w))
+                out += display_image_kitty(png, inline=True, cell_h=cell_h, y_offset=y_offset, cell_w=cell_w, size=(w, h))
 
-            sys.stdout.write(f"\033[{num_spaces}C")
+            out += CURSOR_FORWARD % num_spaces
 
-    sys.stdout.write('\n')
+    out += b"\n"
     if max_rows_down > 0:
-        sys.stdout.write('\n' * max_rows_down)
+        out += b"\n" * max_rows_down
 
-    sys.stdout.flush()
+    if pending is None:
+        write_output(out)
 
 
 def main():
@@ -369,9 +1296,13 @@ def main():
     parser.add_argument("input", nargs="?", help="Input text with LaTeX or path to file.")
     args = parser.parse_args()
 
-    content = ""
     if not sys.stdin.isatty():
-        content = sys.stdin.read()
+        stream = getattr(sys.stdin, "buffer", None)
+        if stream is not None:
+            # Piped input is rendered as it arrives
+            batches = iter_stream_segments(stream)
+        else:
+            batches = [parse_input(sys.stdin.read())]
     elif args.input:
         if os.path.isfile(args.input):
             try:
@@ -382,82 +1313,98 @@ def main():
                 sys.exit(1)
         else:
             content = args.input
+        batches = [parse_input(content)]
     else:
         sys.stderr.write("Error: No input provided.\n")
         sys.exit(1)
 
-    segments = parse_input(content)
+    streaming = not isinstance(batches, list)
     cell_w, cell_h, term_cols, term_rows = get_terminal_cell_dims()
     term_px_width = term_cols * cell_w
     current_line_buffer = []
+    rendered = {}
+
+    # Output for consecutive lines is collected and written in large batches
+    out = bytearray()
+
+    for segments in batches:
+        # Inline equations on a line that is not finished yet keep their renders;
+        # everything else from the previous batch has been written out
+        carried = (inline_math_job(content, cell_h) for item_type, content in current_line_buffer if item_type == 'math')
+        rendered = {job: rendered[job] for job in carried if job in rendered}
+        # Render every equation in this batch up front; output below stays in document order
+        rendered.update(render_segments(segments, cell_h))
+
+        for seg in segments:
+            if is_block_math(seg):
+                if current_line_buffer:
+                    print_buffered_line(current_line_buffer, cell_w, cell_h, rendered, out)
+                    current_line_buffer = []
 
-    for seg in segments:
-        if seg.startswith("$$") and seg.endswith("$$") and len(seg) > 4:
-            if current_line_buffer:
-                print_buffered_line(current_line_buffer, cell_w, cell_h)
-                current_line_buffer = []
-
-            # Sanitize block math
-            clean_content = sanitize_latex(seg[2:-2])
-
-            png_bytes = render_latex_to_png(
-                f"${clean_content}$", dpi=config.BLOCK_MATH_DPI, fontsize=config.BLOCK_MATH_FONT_SIZE, 
-                color="#eeeeee", padding=config.BLOCK_MATH_PADDING
-            )
+                png_bytes, w, h = render_job(block_math_job(seg), rendered, out)
 
-            if png_bytes:
-                # Calculate if scaling is needed
-                w, h = get_png_dimensions(png_bytes)
-                display_cols = None
-                
-                # Check if image width exceeds terminal width
-                if w > term_px_width:
-                    display_cols = term_cols
+                if png_bytes:
+                    # Calculate if scaling is needed
+                    display_cols = None
                 
-                # Optional: "Stretch to full width" interpretation
-                # If the user strictly wants it to stretch even if smaller:
-                # display_cols = term_cols
-                # But typically "rendering partially" implies clipping, so 'fit to width' is safe.
+                    # Check if image width exceeds terminal width
+                    if w > term_px_width:
+                        display_cols = term_cols
                 
-                img_seq, rows_needed = display_image_kitty(
-                    png_bytes, inline=False, cell_h=cell_h, 
-                    cols=display_cols, cell_w=cell_w
-                )
+                    # Optional: "Stretch to full width" interpretation
+                    # If the user strictly wants it to stretch even if smaller:
+                    # display_cols = term_cols
+                    # But typically "rendering partially" implies clipping, so 'fit to width' is safe.
                 
-                # Top Margin
-                for _ in range(config.BLOCK_MATH_MARGIN_TOP): sys.stdout.write("\n")
+                    img_seq, rows_needed = display_image_kitty(
+                        png_bytes, inline=False, cell_h=cell_h, 
+                        cols=display_cols, cell_w=cell_w, size=(w, h)
+                    )
 
-                # Reserve space for image
-                for _ in range(rows_needed): sys.stdout.write("\n")
-                sys.stdout.flush()
+                    # Top Margin
+                    out += b"\n" * config.BLOCK_MATH_MARGIN_TOP
 
-                # Move cursor up to start of image space
-                if rows_needed > 0: sys.stdout.write(f"\033[{rows_needed}A")
-                sys.stdout.write("\r")
-                sys.stdout.write(img_seq)
+                    # Reserve space for image
+                    out += b"\n" * rows_needed
 
-                # Move cursor down to end of image space
-                if rows_needed > 0: sys.stdout.write(f"\033[{rows_needed}B")
-                
-                # Bottom Margin
-                sys.stdout.write("\r")
-                for _ in range(config.BLOCK_MATH_MARGIN_BOTTOM): sys.stdout.write("\n")
-            else:
-                sys.stdout.write(seg + "\n")
+                    # Move cursor up to start of image space
+                    if rows_needed > 0: out += CURSOR_UP % rows_needed
+                    out += b"\r"
+                    out += img_seq
 
-        elif seg.startswith("$") and seg.endswith("$") and len(seg) > 2:
-            current_line_buffer.append(('math', seg))
-        else:
-            parts = seg.split('\n')
-            for i, part in enumerate(parts):
-                if i > 0:
-                    print_buffered_line(current_line_buffer, cell_w, cell_h)
-                    current_line_buffer = []
-                if part:
-                    current_line_buffer.append(('text', part))
+                    # Move cursor down to end of image space
+                    if rows_needed > 0: out += CURSOR_DOWN % rows_needed
+
+                    # Bottom Margin
+                    out += b"\r"
+                    out += b"\n" * config.BLOCK_MATH_MARGIN_BOTTOM
+                else:
+                    out += (seg + "\n").encode("utf-8")
+
+            elif is_inline_math(seg):
+                current_line_buffer.append(('math', seg))
+            else:
+                parts = seg.split('\n')
+                for i, part in enumerate(parts):
+                    if i > 0:
+                        print_buffered_line(current_line_buffer, cell_w, cell_h, rendered, out)
+                        current_line_buffer = []
+                    if part:
+                        current_line_buffer.append(('text', part))
+
+            if len(out) >= OUTPUT_FLUSH_SIZE:
+                write_output(out)
+                out = bytearray()
+
+        # Show what has been read so far before waiting for more input
+        if streaming:
+            write_output(out)
+            out = bytearray()
 
     if current_line_buffer:
-        print_buffered_line(current_line_buffer, cell_w, cell_h)
+        print_buffered_line(current_line_buffer, cell_w, cell_h, rendered, out)
+    write_output(out)
+    shutdown_render_pool()
 
 
 if __name__ == "__main__":